@@ -3,30 +3,206 @@
 
 from __future__ import print_function
 import os
+import re
 import json
+import math
 import flask
 import pickle
+import threading
+from collections import OrderedDict
 import numpy as np
+import tensorflow as tf
 from keras.models import load_model
 from keras.preprocessing import sequence
 
 from awscoreml.resolve import paths
-from awscoreml.train import preprocess_tweet
+from awscoreml.train import preprocess_tweet, hash_texts_to_sequences
+from awscoreml.quantize import load_quantized, is_published, predict
+from awscoreml.profiling import request_profiler, check_admin_token, profile_admin_token
+
+# Several model versions can be served side by side. Every version is a complete training artifact in
+# <model dir>/<name>/<version>/, an artifact directly in <model dir> is served as the default model.
+#
+# Environment Variable            Default Value
+# --------------------            -------------
+# MODEL_SERVER_MODEL_DIR          the directory of paths.model('model.h5')
+# MODEL_SERVER_DEFAULT_MODEL      the artifact in MODEL_SERVER_MODEL_DIR itself
+# MODEL_SERVER_MEMORY_MB          1024, models are evicted least recently used first when they don't fit. The
+#                                 cache and this budget are per gunicorn worker (MODEL_SERVER_WORKERS, one per
+#                                 CPU by default), so the container can use up to workers x this budget
+# MODEL_SERVER_QUANTIZED          true, set to false to serve model.h5 even when a quantized model was published
+#
+# A request picks its model with the X-Model-Version header, or model=<name>/<version> in
+# X-Amzn-SageMaker-Custom-Attributes since sagemaker only forwards that header to the container.
+# <name> on its own selects the highest version of that model and 'default' the model in MODEL_SERVER_MODEL_DIR
+# itself. The served model is reported back the same way, in X-Model-Version and as model=<name>/<version> in
+# X-Amzn-SageMaker-Custom-Attributes, the default model as 'default'.
+model_dir = os.environ.get('MODEL_SERVER_MODEL_DIR', os.path.dirname(paths.model('model.h5')))
+default_model = os.environ.get('MODEL_SERVER_DEFAULT_MODEL', '')
+memory_budget = int(os.environ.get('MODEL_SERVER_MEMORY_MB', 1024)) * 1024 * 1024
+use_quantized = os.environ.get('MODEL_SERVER_QUANTIZED', 'true').lower() == 'true'
+
+model_name_pattern = re.compile(r'^[\w-]+(\.[\w-]+)*(/[\w-]+(\.[\w-]+)*)?$')
+
+
+def version_key(version):
+    """Sorts versions numerically where possible so that 10 comes after 9"""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'(\d+)', version)]
+
+
+class ServedModel(object):
+    """One loaded training artifact: the feature encoding plus either the quantized or the keras model"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tokenizer = None
+        self.quantized = None
+        self.keras_model = None
+
+        # artifacts trained before features.json existed only have a tokenizer
+        self.features = {'mode': 'tokenizer', 'maxlen': 20}
+        if os.path.exists(os.path.join(directory, 'features.json')):
+            with open(os.path.join(directory, 'features.json')) as handle:
+                self.features = json.load(handle)
+
+        if self.features['mode'] == 'tokenizer':
+            with open(os.path.join(directory, 'tokenizer.pickle'), 'rb') as handle:
+                self.tokenizer = pickle.load(handle)
+        elif self.features['mode'] != 'hashing':
+            raise ValueError('Unknown feature mode ' + str(self.features['mode']))
+
+        if use_quantized and is_published(directory):
+            # memory mapped, pages are only read when a request touches them and can be shared between workers
+            self.quantized = load_quantized(os.path.join(directory, 'quantized'), mmap_mode='r')
+            self.size = ServedModel.disk_size(os.path.join(directory, 'quantized'))
+        else:
+            # every keras model gets its own graph and session so closing them on eviction really frees it,
+            # loading into the global TF1 graph would keep every model ever loaded alive
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                self.session = tf.Session(graph=self.graph)
+                with self.session.as_default():
+                    self.keras_model = load_model(os.path.join(directory, 'model.h5'))
+            self.size = ServedModel.disk_size(os.path.join(directory, 'model.h5'))
+
+    @staticmethod
+    def is_artifact(directory):
+        return os.path.exists(os.path.join(directory, 'model.h5'))
+
+    @staticmethod
+    def disk_size(path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+    def encode(self, tweets):
+        if self.features['mode'] == 'hashing':
+            return hash_texts_to_sequences(tweets, self.features)
+        t = self.tokenizer.texts_to_sequences(tweets)
+        return np.array(sequence.pad_sequences(t, maxlen=self.features['maxlen'], padding='post'))
+
+    def predict(self, X):
+        if self.quantized is not None:
+            return predict(self.quantized, X)
+        with self.graph.as_default(), self.session.as_default():
+            return self.keras_model.predict(X)
+
+    def close(self):
+        """Releases the model, the memory mapped weights are unmapped once the arrays are dropped"""
+        if self.keras_model is not None:
+            self.session.close()
+            self.keras_model = None
+        self.quantized = None
 
 
 class ScoringService(object):
-    model = None
+    models = OrderedDict()
+    memory_used = 0
+    lock = threading.Lock()
 
     @classmethod
     def get_model(cls):
-        """This class method just checks if the model path is available to us"""
+        """This class method just checks if any model is available to us"""
 
-        if os.path.exists(paths.model('model.h5')):
-            cls.model = True
-        else:
-            cls.model = None
+        if ServedModel.is_artifact(model_dir) or cls.versions():
+            return True
+        return None
+
+    @classmethod
+    def versions(cls):
+        """Lists every <name>/<version> found in the model directory"""
+
+        found = []
+        for name in sorted(os.listdir(model_dir)) if os.path.isdir(model_dir) else []:
+            if not os.path.isdir(os.path.join(model_dir, name)):
+                continue
+            for version in os.listdir(os.path.join(model_dir, name)):
+                if ServedModel.is_artifact(os.path.join(model_dir, name, version)):
+                    found.append(name + '/' + version)
+        return found
+
+    @classmethod
+    def resolve(cls, target):
+        """
+        Maps the model requested in a header to a '<name>/<version>' key, '' is the default model
+        :return: the key or None when no such model exists
+        """
+        target = (target or default_model).strip('/')
+        if not target or target == 'default':
+            return '' if ServedModel.is_artifact(model_dir) else None
+        if not model_name_pattern.match(target):
+            return None
+        if '/' not in target:
+            versions = [v for v in os.listdir(os.path.join(model_dir, target))
+                        if ServedModel.is_artifact(os.path.join(model_dir, target, v))] \
+                if os.path.isdir(os.path.join(model_dir, target)) else []
+            if not versions:
+                return None
+            target = target + '/' + max(versions, key=version_key)
+        return target if ServedModel.is_artifact(os.path.join(model_dir, target)) else None
+
+    @classmethod
+    def get(cls, key):
+        """Returns the loaded model for key, loading it and evicting least recently used models if needed"""
+
+        with cls.lock:
+            if key in cls.models:
+                cls.models.move_to_end(key)
+                return cls.models[key]
+
+        # load without holding the lock so requests for cached models are not blocked by a cold load
+        served = ServedModel(os.path.join(model_dir, key) if key else model_dir)
+
+        with cls.lock:
+            if key in cls.models:
+                # another request loaded the same model in the meantime
+                served.close()
+                cls.models.move_to_end(key)
+                return cls.models[key]
 
-        return cls.model
+            # requests never yield between get() and predict() under the gevent workers, so no request can
+            # still be using a model that is closed here
+            while cls.models and cls.memory_used + served.size > memory_budget:
+                evicted_key, evicted = cls.models.popitem(last=False)
+                cls.memory_used -= evicted.size
+                evicted.close()
+                print('evicted model ' + (evicted_key or 'default'))
+            cls.models[key] = served
+            cls.memory_used += served.size
+            return served
+
+
+def requested_model():
+    """Reads the requested model from the X-Model-Version or the sagemaker custom attributes header"""
+
+    if 'X-Model-Version' in flask.request.headers:
+        return flask.request.headers['X-Model-Version']
+    attributes = flask.request.headers.get('X-Amzn-SageMaker-Custom-Attributes', '')
+    for attribute in attributes.split(','):
+        key, _, value = attribute.strip().partition('=')
+        if key == 'model':
+            return value
+    return None
 
 
 app = flask.Flask(__name__)
@@ -42,6 +218,7 @@ def ping():
 
 
 @app.route('/invocations', methods=['POST'])
+@request_profiler
 def transformation():
     """This method reads in the data (json object) sent with the request and returns a prediction
     as response """
@@ -52,21 +229,44 @@ def transformation():
         data = flask.request.data.decode('utf-8')
         data = json.loads(data)
 
-        model = load_model(paths.model('model.h5'))
-
-        with open(paths.model('tokenizer.pickle'), 'rb') as handle:
-            tk = pickle.load(handle)
+        key = ScoringService.resolve(requested_model())
+        if key is None:
+            return flask.Response(response='Unknown model', status=404, mimetype='text/plain')
+        served = ScoringService.get(key)
 
         one_tweet = preprocess_tweet(data['data'])
         one_tweet = np.array([one_tweet])
-        t = tk.texts_to_sequences(one_tweet)
-        X_test = np.array(sequence.pad_sequences(t, maxlen=20, padding='post'))
 
-        prediction = model.predict(X_test)
+        X_test = served.encode(one_tweet)
+        prediction = served.predict(X_test)
         result = {"prediction": str(prediction[0][0])}
 
     else:
         return flask.Response(response='This predictor only supports JSON data', status=415, mimetype='text/plain')
     print(data)
     print(type(data))
-    return flask.Response(response=json.dumps(result), status=200, mimetype='application/json')
+    # sagemaker only passes X-Amzn-SageMaker-Custom-Attributes back to InvokeEndpoint callers
+    return flask.Response(response=json.dumps(result), status=200, mimetype='application/json',
+                          headers={'X-Model-Version': key or 'default',
+                                   'X-Amzn-SageMaker-Custom-Attributes': 'model=' + (key or 'default')})
+
+
+if profile_admin_token:
+    @app.route('/admin/profile', methods=['POST'])
+    def start_profiling():
+        """Profiles every /invocations request of all workers for the next ?seconds=N seconds (default 60)"""
+
+        if not check_admin_token(flask.request.headers.get('X-Profile-Token', '')):
+            return flask.Response(response='Forbidden', status=403, mimetype='text/plain')
+
+        try:
+            seconds = float(flask.request.args.get('seconds', 60))
+        except ValueError:
+            seconds = float('nan')
+        if not math.isfinite(seconds) or seconds <= 0:
+            return flask.Response(response='seconds must be a positive number', status=400, mimetype='text/plain')
+        seconds = min(seconds, 3600.)
+
+        until = request_profiler.start_window(seconds)
+        return flask.Response(response=json.dumps({"profiling_until": until}), status=200,
+                              mimetype='application/json')
@@ -0,0 +1,225 @@
+# Opt-in profiling for the training job and the scoring service. Everything is driven by environment variables
+# and does nothing unless one of them is set:
+#
+# Environment Variable     Used by        Meaning
+# --------------------     -------        -------
+# TRAINING_PROFILE         training       "true" profiles every stage of entry_point() and times every epoch/batch
+# PROFILE_EVERY_N          serving        profile every Nth /invocations request of each worker
+# PROFILE_ADMIN_TOKEN      serving        enables POST /admin/profile?seconds=N, which profiles every request of
+#                                         every worker for the next N seconds. The token must be sent in the
+#                                         X-Profile-Token header
+# PROFILE_DIR              both           where reports are written. Training defaults to the paths.output
+#                                         location, serving only prints to stdout unless this is set
+# PROFILE_KEEP             serving        number of report files each worker rotates through in PROFILE_DIR,
+#                                         defaults to 20, 0 only prints reports
+# PROFILE_TOP              both           number of functions listed in each report, defaults to 30
+
+from __future__ import print_function
+import os
+import io
+import json
+import time
+import hmac
+import cProfile
+import pstats
+import functools
+from contextlib import contextmanager
+
+from awscoreml.resolve import paths
+
+
+training_profile = os.environ.get('TRAINING_PROFILE', 'false').lower() == 'true'
+profile_every_n = int(os.environ.get('PROFILE_EVERY_N', 0))
+profile_admin_token = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+profile_top = int(os.environ.get('PROFILE_TOP', 30))
+profile_keep = int(os.environ.get('PROFILE_KEEP', 20))
+
+
+def report_path(filename, failed=False):
+    """
+    Resolves where a report is written. Successful runs go next to the model so they end up in model.tar.gz,
+    failed training stages go next to paths.failure() so they are kept with the job output.
+    :param filename: name of the report file
+    :param failed: True when the profiled code raised an exception
+    :return: path of the report
+    """
+    if 'PROFILE_DIR' in os.environ:
+        return os.path.join(os.environ['PROFILE_DIR'], filename)
+    if failed:
+        return os.path.join(os.path.dirname(paths.failure()), filename)
+    return paths.output(filename)
+
+
+def write_report(profiler, header, filename=None, failed=False):
+    """
+    Prints the cumulative pstats of profiler to stdout for the container logs and writes them to a report file.
+    :param profiler: a disabled cProfile.Profile
+    :param header: first line of the report
+    :param filename: name of the report file, None to only print the report
+    :param failed: passed to report_path
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(profile_top)
+    report = header + '\n' + stream.getvalue()
+    print(report)
+    if filename is None:
+        return
+    try:
+        path = report_path(filename, failed)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as handle:
+            handle.write(report)
+    except (IOError, OSError) as e:
+        print('could not write profile report ' + filename + ': ' + str(e))
+
+
+@contextmanager
+def stage(name):
+    """
+    Profiles one stage of the training job when TRAINING_PROFILE is set, otherwise does nothing.
+    :param name: name of the stage, used in the report file name profile-train-<name>.txt
+    """
+    if not training_profile:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    start = time.time()
+    failed = False
+    profiler.enable()
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        profiler.disable()
+        header = 'stage {} {} after {:.3f}s'.format(name, 'failed' if failed else 'finished', time.time() - start)
+        write_report(profiler, header, 'profile-train-{}.txt'.format(name), failed)
+
+
+def training_callbacks():
+    """
+    :return: the keras callbacks used to profile model.fit, an empty list when TRAINING_PROFILE is not set
+    """
+    if not training_profile:
+        return []
+
+    from keras.callbacks import Callback
+
+    class EpochTimer(Callback):
+        """Records the wall time of every epoch and the mean/max batch time within it"""
+
+        def on_train_begin(self, logs=None):
+            self.epochs = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch_start = time.time()
+            self.batch_times = []
+
+        def on_batch_begin(self, batch, logs=None):
+            self.batch_start = time.time()
+
+        def on_batch_end(self, batch, logs=None):
+            self.batch_times.append(time.time() - self.batch_start)
+
+        def on_epoch_end(self, epoch, logs=None):
+            batches = len(self.batch_times)
+            self.epochs.append({
+                'epoch': epoch,
+                'seconds': time.time() - self.epoch_start,
+                'batches': batches,
+                'mean_batch_seconds': sum(self.batch_times) / batches if batches else 0.,
+                'max_batch_seconds': max(self.batch_times) if batches else 0.,
+            })
+            print('epoch timing:' + json.dumps(self.epochs[-1]))
+
+        def on_train_end(self, logs=None):
+            try:
+                with open(report_path('profile-train-epochs.json'), 'w') as handle:
+                    json.dump(self.epochs, handle)
+            except (IOError, OSError) as e:
+                print('could not write epoch timings: ' + str(e))
+
+    return [EpochTimer()]
+
+
+class RequestProfiler(object):
+    """
+    Decides which requests are profiled, either every Nth request of this worker or all requests during a window.
+    The window is shared by all gunicorn workers through the modification time of window_file.
+    """
+
+    window_file = os.path.join(os.sep, 'tmp', 'awscoreml-profile-window')
+
+    def __init__(self, every_n=0):
+        self.every_n = every_n
+        self.count = 0
+        # only one profiler can be attached to the interpreter, gevent requests of this worker must not overlap
+        self.active = False
+
+    def start_window(self, seconds):
+        with open(self.window_file, 'a'):
+            pass
+        until = time.time() + seconds
+        os.utime(self.window_file, (until, until))
+        return until
+
+    def should_profile(self):
+        """
+        :return: the number of this request within the worker when it should be profiled, otherwise 0
+        """
+        self.count += 1
+        number = self.count
+        if self.active:
+            return 0
+        if self.every_n and number % self.every_n == 0:
+            return number
+        if not profile_admin_token:
+            return 0
+        try:
+            return number if time.time() < os.path.getmtime(self.window_file) else 0
+        except OSError:
+            return 0
+
+    def __call__(self, view):
+        """Decorates a flask view, returned unchanged when request profiling is not configured"""
+        if not self.every_n and not profile_admin_token:
+            return view
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            number = self.should_profile()
+            if not number:
+                return view(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            start = time.time()
+            self.active = True
+            try:
+                return profiler.runcall(view, *args, **kwargs)
+            finally:
+                self.active = False
+                header = 'request {} of worker {} took {:.3f}s'.format(number, os.getpid(), time.time() - start)
+                filename = None
+                if 'PROFILE_DIR' in os.environ and profile_keep > 0:
+                    # rotate through a fixed set of files so a busy endpoint can not fill up the disk
+                    filename = 'profile-serve-{}-{}.txt'.format(os.getpid(), number % profile_keep)
+                write_report(profiler, header, filename)
+
+        return wrapper
+
+
+request_profiler = RequestProfiler(profile_every_n)
+
+
+def check_admin_token(token):
+    """
+    :param token: the token sent with an admin request
+    :return: True only when PROFILE_ADMIN_TOKEN is set and matches token
+    """
+    # compare bytes, compare_digest raises TypeError for str with non-ascii characters
+    return bool(profile_admin_token) and hmac.compare_digest(str(token).encode('utf-8'),
+                                                             profile_admin_token.encode('utf-8'))
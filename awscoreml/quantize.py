@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+from awscoreml.resolve import paths
+
+
+SUPPORTED_LAYERS = ('Embedding', 'Conv1D', 'MaxPooling1D', 'Dropout', 'Flatten', 'Dense')
+
+# largest difference check_parity accepts between keras and predict running the same float32 weights
+PARITY_TOLERANCE = 1e-4
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    'tanh': np.tanh,
+}
+
+
+def quantize_per_channel(weights, axis):
+    """
+    Symmetric int8 quantization with one scale per channel along axis.
+    :param weights: float numpy array
+    :param axis: the channel axis, every other axis shares the scale of its channel
+    :return: tuple of (int8 array with the shape of weights, float32 scales with one entry per channel)
+    """
+    axis = axis % weights.ndim
+    reduce_axes = tuple(i for i in range(weights.ndim) if i != axis)
+    scale = np.max(np.abs(weights), axis=reduce_axes, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+    return q, scale.reshape(-1).astype(np.float32)
+
+
+def quantize_model(model):
+    """
+    Converts the Embedding, Conv1D and Dense weights of a trained keras Sequential model to int8.
+    :param model: the trained keras model
+    :return: dict with a json serializable 'spec' (one entry per layer) and the numpy 'arrays' it refers to
+    """
+    spec = []
+    arrays = {}
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind not in SUPPORTED_LAYERS:
+            raise ValueError('Layer {} of type {} can not be quantized'.format(layer.name, kind))
+        config = layer.get_config()
+        entry = {'type': kind, 'name': layer.name}
+
+        if kind == 'Embedding':
+            # one scale per row so a lookup only touches the scales of the tokens it uses
+            arrays[layer.name + '.kernel'], arrays[layer.name + '.scale'] = \
+                quantize_per_channel(layer.get_weights()[0], axis=0)
+        elif kind in ('Conv1D', 'Dense'):
+            kernel, bias = layer.get_weights()
+            arrays[layer.name + '.kernel'], arrays[layer.name + '.scale'] = quantize_per_channel(kernel, axis=-1)
+            arrays[layer.name + '.bias'] = bias.astype(np.float32)
+            entry['activation'] = config['activation']
+            if kind == 'Conv1D':
+                entry['padding'] = config['padding']
+                if config['padding'] not in ('same', 'valid'):
+                    raise ValueError('Only Conv1D layers with same or valid padding can be quantized')
+                if tuple(config['strides']) != (1,) or tuple(config['dilation_rate']) != (1,):
+                    raise ValueError('Only Conv1D layers with strides and dilation_rate of 1 can be quantized')
+        elif kind == 'MaxPooling1D':
+            entry['pool_size'] = int(np.ravel(config['pool_size'])[0])
+            entry['strides'] = int(np.ravel(config['strides'])[0])
+            if config['padding'] != 'valid':
+                raise ValueError('Only MaxPooling1D layers with valid padding can be quantized')
+
+        if entry.get('activation', 'linear') not in ACTIVATIONS:
+            raise ValueError('Activation {} of layer {} is not supported'.format(entry['activation'], layer.name))
+        spec.append(entry)
+
+    return {'spec': spec, 'arrays': arrays}
+
+
+def save_quantized(quantized, directory):
+    """
+    Writes a quantized model as spec.json plus one .npy file per array. Everything is written to a temporary
+    directory first and renamed into place, so an interrupted export never leaves a partial model behind.
+    :param quantized: the dict returned by quantize_model
+    :param directory: path of the output directory, it is replaced if it already exists
+    """
+    staging = directory + '.tmp'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    for name, array in quantized['arrays'].items():
+        np.save(os.path.join(staging, name + '.npy'), array)
+    with open(os.path.join(staging, 'spec.json'), 'w') as handle:
+        json.dump(quantized['spec'], handle)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(staging, directory)
+
+
+def unpublish_quantized():
+    """
+    Removes the quantized model and its report from paths.model, used whenever this training run does not
+    publish a quantized model so the scoring service can never pair an old one with a new model.h5
+    """
+    if os.path.exists(paths.model('quantized')):
+        shutil.rmtree(paths.model('quantized'))
+    if os.path.exists(paths.model('quantization.json')):
+        os.remove(paths.model('quantization.json'))
+
+
+def is_published(model_dir):
+    """
+    :param model_dir: directory of a training artifact
+    :return: True when the training run that produced model_dir published its quantized model
+    """
+    report_path = os.path.join(model_dir, 'quantization.json')
+    if not os.path.exists(report_path) or not os.path.exists(os.path.join(model_dir, 'quantized', 'spec.json')):
+        return False
+    with open(report_path) as handle:
+        return bool(json.load(handle).get('published'))
+
+
+def load_quantized(directory, mmap_mode=None):
+    """
+    Reads a quantized model written by save_quantized
+    :param directory: path of the quantized model directory
+    :param mmap_mode: passed to numpy.load, use 'r' to memory map the weights instead of reading them
+    :return: dict with the same layout as the one returned by quantize_model
+    """
+    with open(os.path.join(directory, 'spec.json')) as handle:
+        spec = json.load(handle)
+    arrays = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy'):
+            arrays[filename[:-len('.npy')]] = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+    return {'spec': spec, 'arrays': arrays}
+
+
+def _conv1d(x, kernel, scale, bias, padding):
+    size = kernel.shape[0]
+    if padding == 'same':
+        # same split as tensorflow: the extra padding of even kernels goes to the right
+        left = (size - 1) // 2
+        x = np.pad(x, ((0, 0), (left, size - 1 - left), (0, 0)), mode='constant')
+    steps = x.shape[1] - size + 1
+    out = np.zeros((x.shape[0], steps, kernel.shape[2]), dtype=np.float32)
+    for j in range(size):
+        out += np.matmul(x[:, j:j + steps, :], kernel[j].astype(np.float32))
+    return out * scale + bias
+
+
+def _max_pooling1d(x, pool_size, strides):
+    steps = (x.shape[1] - pool_size) // strides + 1
+    windows = [x[:, j:j + (steps - 1) * strides + 1:strides, :] for j in range(pool_size)]
+    return np.max(np.stack(windows), axis=0)
+
+
+def predict(quantized, X, batch_size=1024):
+    """
+    Runs the quantized model on a batch of padded sequences with numpy only
+    :param quantized: the dict returned by quantize_model or load_quantized
+    :param X: integer numpy array of shape (samples, maxlen)
+    :param batch_size: number of samples evaluated at once
+    :return: numpy array with the model output, the same shape keras model.predict returns
+    """
+    arrays = quantized['arrays']
+    outputs = []
+    for start in range(0, X.shape[0], batch_size):
+        x = X[start:start + batch_size]
+        for entry in quantized['spec']:
+            kind = entry['type']
+            name = entry['name']
+            if kind == 'Embedding':
+                x = arrays[name + '.kernel'][x].astype(np.float32) * arrays[name + '.scale'][x][..., np.newaxis]
+            elif kind == 'Conv1D':
+                x = _conv1d(x, arrays[name + '.kernel'], arrays[name + '.scale'], arrays[name + '.bias'],
+                            entry['padding'])
+            elif kind == 'MaxPooling1D':
+                x = _max_pooling1d(x, entry['pool_size'], entry['strides'])
+            elif kind == 'Flatten':
+                x = x.reshape(x.shape[0], -1)
+            elif kind == 'Dense':
+                x = np.matmul(x, arrays[name + '.kernel'].astype(np.float32)) * arrays[name + '.scale'] \
+                    + arrays[name + '.bias']
+            if 'activation' in entry:
+                x = ACTIVATIONS[entry['activation']](x)
+        outputs.append(x)
+    return np.concatenate(outputs)
+
+
+def check_parity():
+    """
+    Runs a tiny keras Sequential model, with an even Conv1D kernel, same and valid padding and overlapping pooling,
+    through keras and through predict. Keras is given the dequantized weights, so both compute the same function
+    and any difference comes from the layout of the numpy forward pass rather than from quantization.
+    :return: the largest absolute difference between the two predictions
+    """
+    from keras.models import Sequential
+    from keras.layers import Dense, Flatten, Conv1D, MaxPooling1D, Dropout
+    from keras.layers.embeddings import Embedding
+
+    model = Sequential()
+    model.add(Embedding(16, 4, input_length=11))
+    model.add(Conv1D(filters=3, kernel_size=4, padding='same', activation='relu'))
+    model.add(MaxPooling1D(pool_size=2))
+    model.add(Dropout(0.2))
+    model.add(Conv1D(filters=2, kernel_size=3, padding='valid', activation='tanh'))
+    model.add(MaxPooling1D(pool_size=2, strides=1))
+    model.add(Flatten())
+    model.add(Dense(1, activation='sigmoid'))
+
+    quantized = quantize_model(model)
+    arrays = quantized['arrays']
+    for layer in model.layers:
+        if not layer.get_weights():
+            continue
+        kernel = arrays[layer.name + '.kernel'].astype(np.float32)
+        if layer.__class__.__name__ == 'Embedding':
+            layer.set_weights([kernel * arrays[layer.name + '.scale'][:, np.newaxis]])
+        else:
+            layer.set_weights([kernel * arrays[layer.name + '.scale'], arrays[layer.name + '.bias']])
+
+    X = np.random.RandomState(0).randint(0, 16, size=(8, 11))
+    return float(np.max(np.abs(model.predict(X) - predict(quantized, X))))
+
+
+def export_quantized(model, X_val, y_val, max_accuracy_drop, max_prediction_diff=0.05, deadline=None):
+    """
+    Quantizes the trained model, compares it with the float model on the validation data and only publishes it to
+    paths.model('quantized') when the accuracy drop is within max_accuracy_drop, no prediction moves by more than
+    max_prediction_diff and check_parity passes.
+    The comparison is always written to paths.model('quantization.json'), its 'published' flag is what the
+    scoring service checks before it serves the quantized model.
+    :param model: the trained keras model
+    :param X_val: validation sequences
+    :param y_val: validation labels (0 or 1)
+    :param max_accuracy_drop: largest accepted difference between float and quantized accuracy
+    :param max_prediction_diff: largest accepted absolute difference between a float and a quantized prediction
+    :param deadline: time.time() by which the export has to be finished, validation uses fewer samples to meet it
+    :return: the report dict, None when there was not enough time left to validate the quantized model
+    """
+    unpublish_quantized()
+    quantized = quantize_model(model)
+
+    if deadline is not None:
+        # time both models on a small probe, then only validate on as many samples as fit in half the time left
+        # so the other half remains for writing the quantized model
+        probe = X_val[:256]
+        probe_start = time.time()
+        model.predict(probe)
+        predict(quantized, probe)
+        per_sample = (time.time() - probe_start) / max(probe.shape[0], 1)
+        samples = int((deadline - time.time()) / 2. / per_sample) if per_sample > 0 else X_val.shape[0]
+        if samples < probe.shape[0]:
+            print("quantized model not published: not enough time left to validate it")
+            return None
+        if samples < X_val.shape[0]:
+            print("validating the quantized model on " + str(samples) + " samples to stay within the time budget")
+            X_val, y_val = X_val[:samples], y_val[:samples]
+
+    float_predictions = model.predict(X_val)
+    quantized_predictions = predict(quantized, X_val)
+    float_accuracy = float(np.mean((float_predictions[:, 0] > 0.5) == y_val))
+    quantized_accuracy = float(np.mean((quantized_predictions[:, 0] > 0.5) == y_val))
+    accuracy_drop = float_accuracy - quantized_accuracy
+    max_abs_prediction_diff = float(np.max(np.abs(float_predictions - quantized_predictions)))
+    parity_diff = check_parity()
+
+    report = {
+        'float_accuracy': float_accuracy,
+        'quantized_accuracy': quantized_accuracy,
+        'accuracy_drop': accuracy_drop,
+        'max_accuracy_drop': max_accuracy_drop,
+        'max_abs_prediction_diff': max_abs_prediction_diff,
+        'max_prediction_diff': max_prediction_diff,
+        'parity_diff': parity_diff,
+        'validation_samples': int(X_val.shape[0]),
+        'float_bytes': int(sum(w.nbytes for w in model.get_weights())),
+        'quantized_bytes': int(sum(a.nbytes for a in quantized['arrays'].values())),
+        'published': accuracy_drop <= max_accuracy_drop and max_abs_prediction_diff <= max_prediction_diff
+                     and parity_diff <= PARITY_TOLERANCE
+    }
+
+    if report['published']:
+        save_quantized(quantized, paths.model('quantized'))
+    else:
+        print("quantized model not published: accuracy dropped by " + str(accuracy_drop) +
+              ", predictions moved by up to " + str(max_abs_prediction_diff) + ", parity check differed by " +
+              str(parity_diff))
+
+    with open(paths.model('quantization.json'), 'w') as handle:
+        json.dump(report, handle)
+    print("quantization:" + json.dumps(report))
+    return report
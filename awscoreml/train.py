@@ -1,17 +1,23 @@
 import os
 import re
 import json
+import time
+import zlib
+from collections import Counter
 import numpy as np
 import pandas as pd
 from keras.preprocessing import sequence
-from keras.preprocessing.text import Tokenizer
+from keras.preprocessing.text import Tokenizer, text_to_word_sequence
 from keras.models import Sequential
 from keras.layers import Dense, Flatten, Conv1D, MaxPooling1D, Dropout
 from keras.layers.embeddings import Embedding
+from keras.callbacks import Callback, EarlyStopping
 import pickle
 
 
 from awscoreml.resolve import paths
+from awscoreml.quantize import export_quantized, unpublish_quantized
+from awscoreml.profiling import stage, training_callbacks
 
 
 def read_config_file(config_json):
@@ -26,6 +32,76 @@ def read_config_file(config_json):
         return json.loads(json_data)
 
 
+def get_hyper_param(hyper_params, name, default):
+    """
+    Looks up a single hyperparameter. SageMaker passes every hyperparameter as a string so the value is cast to
+    the type of the default.
+    :param hyper_params: the dict returned by read_config_file (may be None when no file is present)
+    :param name: name of the hyperparameter
+    :param default: value used when the hyperparameter is not set
+    :return: the hyperparameter value with the same type as default
+    """
+    if hyper_params and name in hyper_params:
+        return type(default)(hyper_params[name])
+    return default
+
+
+def write_failure(message):
+    """
+    Writes the reason a training job failed to the location sagemaker reads its FailureReason from
+    :param message: the failure reason, sagemaker keeps the first 1024 characters
+    """
+    print(message)
+    with open(paths.failure(), 'w') as handle:
+        handle.write(message)
+
+
+class TrainingBudget(Callback):
+    """
+    Keeps the weights of the epoch with the best val_loss and stops training early enough to finish before deadline.
+    An epoch is only started if the slowest epoch so far still fits, and a running epoch is interrupted once the
+    deadline has passed. The best weights are restored when training ends, however it ended.
+    """
+
+    def __init__(self, deadline=None, monitor='val_loss'):
+        super(TrainingBudget, self).__init__()
+        self.deadline = deadline
+        self.monitor = monitor
+
+    def on_train_begin(self, logs=None):
+        self.best = np.inf
+        self.best_weights = None
+        self.best_epoch = None
+        self.longest_epoch = 0.
+        self.out_of_time = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.out_of_time = True
+            self.model.stop_training = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.longest_epoch = max(self.longest_epoch, time.time() - self.epoch_start)
+        current = (logs or {}).get(self.monitor)
+        if current is not None and current < self.best:
+            self.best = current
+            self.best_weights = self.model.get_weights()
+            self.best_epoch = epoch
+
+        if self.deadline is not None and time.time() + self.longest_epoch > self.deadline:
+            print("stopping after epoch " + str(epoch) + ": the next epoch would not finish before the time budget")
+            self.out_of_time = True
+            self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            print("restoring weights of epoch " + str(self.best_epoch) + " with " + self.monitor + " " + str(self.best))
+            self.model.set_weights(self.best_weights)
+
+
 def preprocess_tweet(tweet):
     """
     preprocess the text in a single tweet. convert all urls to sting "URL"
@@ -43,64 +119,184 @@ def preprocess_tweet(tweet):
     return tweet
 
 
+def hash_token(token, num_buckets):
+    """
+    Maps a single token to one of num_buckets buckets. crc32 is used instead of the builtin hash() because it is
+    stable across processes and python versions, so training and serving always agree.
+    :param token: a cleaned word
+    :param num_buckets: the number of hash buckets
+    :return: the bucket index of the token
+    """
+    return (zlib.crc32(token.encode('utf-8')) & 0xffffffff) % num_buckets
+
+
+def build_hash_features(tweets, vocab_size, exact_words=0, maxlen=20):
+    """
+    Builds the feature description used by the hashing vocabulary mode. Row 0 of the embedding is kept for padding,
+    rows 1..exact_words hold the most frequent words in tweets and the remaining rows are hash buckets.
+    :param tweets: the preprocessed tweets used to pick the exact-match words (ignored when exact_words is 0)
+    :param vocab_size: number of rows in the embedding layer
+    :param exact_words: size of the exact-match table
+    :param maxlen: length every sequence is padded or truncated to
+    :return: a json serializable dict that is saved next to the model as features.json
+    """
+    if vocab_size <= exact_words + 1:
+        raise ValueError('vocab_size must be larger than hash_exact_words + 1')
+
+    exact = {}
+    if exact_words > 0:
+        counts = Counter(word for tweet in tweets for word in text_to_word_sequence(tweet))
+        for index, (word, _) in enumerate(counts.most_common(exact_words)):
+            exact[word] = index + 1
+
+    return {'mode': 'hashing', 'vocab_size': vocab_size, 'maxlen': maxlen, 'exact': exact}
+
+
+def hash_texts_to_sequences(tweets, features):
+    """
+    Converts preprocessed tweets to padded sequences of embedding rows using the hashing vocabulary mode.
+    This is used by both the training job and the scoring service so the two are always identical.
+    :param tweets: iterable of preprocessed tweets
+    :param features: the dict returned by build_hash_features (or loaded from features.json)
+    :return: numpy array of shape (len(tweets), maxlen)
+    """
+    exact = features['exact']
+    offset = len(exact) + 1
+    num_buckets = features['vocab_size'] - offset
+
+    t = []
+    for tweet in tweets:
+        t.append([exact[word] if word in exact else offset + hash_token(word, num_buckets)
+                  for word in text_to_word_sequence(tweet)])
+    return np.array(sequence.pad_sequences(t, maxlen=features['maxlen'], padding='post'))
+
+
 def entry_point():
     """
     This function trains the model prameters and same them
     read data , describe model graph and finally train model
     return: initiates the keras training job and saved model.h5 file at the end
     """
-    dataframe = pd.read_csv(paths.input(channel='validation', filename="training.1600000.processed.noemoticon.csv"), error_bad_lines=False, encoding="ISO-8859-1", header=None).iloc[:, [0, 4, 5]].sample(frac=1).reset_index(drop=True)
-    tweets = np.array(dataframe.iloc[:, 2].apply(preprocess_tweet).values)
-    sentiment = np.array(dataframe.iloc[:, 0].values)
-
-    hyper_params = read_config_file('hyperparameters.json')
-    vocab_size = int(30)
-
-    tk = Tokenizer(num_words=vocab_size)
-    tk.fit_on_texts(tweets)
-
-    with open(paths.model('tokenizer.pickle'), 'wb') as handle:
-        pickle.dump(tk, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    t = tk.texts_to_sequences(tweets)
-    X = np.array(sequence.pad_sequences(t, maxlen=20, padding='post'))
-    y = sentiment
-    print(X.shape, y.shape)
-    y[y == 4] = 1
-
-    model = Sequential()
-    model.add(Embedding(vocab_size, 32, input_length=20))
-    model.add(Conv1D(filters=128, kernel_size=5, padding='same', activation='relu'))
-    model.add(MaxPooling1D(pool_size=2))
-    model.add(Dropout(0.2))
-    model.add(Conv1D(filters=64, kernel_size=6, padding='same', activation='relu'))
-    model.add(MaxPooling1D(pool_size=2))
-    model.add(Dropout(0.2))
-    model.add(Conv1D(filters=32, kernel_size=7, padding='same', activation='relu'))
-    model.add(MaxPooling1D(pool_size=2))
-    model.add(Dropout(0.2))
-    model.add(Conv1D(filters=32, kernel_size=8, padding='same', activation='relu'))
-    model.add(MaxPooling1D(pool_size=2))
-    model.add(Dropout(0.2))
-    model.add(Flatten())
-    model.add(Dense(1, activation='sigmoid'))
-
-    model.compile(
-        loss='binary_crossentropy',
-        optimizer='adam',
-        metrics=['accuracy']
-    )
-    model.summary()
-
-    history = model.fit(
-        X, y,
-        batch_size=int(10),
-        verbose=1,
-        validation_split=float(0.2),
-        epochs=int(1)
-    )
-
-    model.save(paths.model(filename='model.h5'))
+    start = time.time()
+    try:
+        with stage('read'):
+            dataframe = pd.read_csv(paths.input(channel='validation', filename="training.1600000.processed.noemoticon.csv"), error_bad_lines=False, encoding="ISO-8859-1", header=None).iloc[:, [0, 4, 5]].sample(frac=1).reset_index(drop=True)
+            tweets = np.array(dataframe.iloc[:, 2].apply(preprocess_tweet).values)
+            sentiment = np.array(dataframe.iloc[:, 0].values)
+
+        with stage('features'):
+            hyper_params = read_config_file('hyperparameters.json')
+            # number of embedding rows in both modes: the tokenizer's num_words, or the exact-match table plus the
+            # hash buckets
+            vocab_size = get_hyper_param(hyper_params, 'vocab_size', 10000)
+            feature_mode = get_hyper_param(hyper_params, 'feature_mode', 'tokenizer')
+
+            if feature_mode == 'hashing':
+                # single pass: the exact-match table only looks at a prefix of the data, everything else is hashed
+                exact_sample = get_hyper_param(hyper_params, 'hash_exact_sample', 10000)
+                features = build_hash_features(tweets[:exact_sample], vocab_size,
+                                               exact_words=get_hyper_param(hyper_params, 'hash_exact_words', 0))
+
+                if os.path.exists(paths.model('tokenizer.pickle')):
+                    os.remove(paths.model('tokenizer.pickle'))
+
+                X = hash_texts_to_sequences(tweets, features)
+            else:
+                tk = Tokenizer(num_words=vocab_size)
+                tk.fit_on_texts(tweets)
+                features = {'mode': 'tokenizer', 'vocab_size': vocab_size, 'maxlen': 20}
+
+                with open(paths.model('tokenizer.pickle'), 'wb') as handle:
+                    pickle.dump(tk, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+                t = tk.texts_to_sequences(tweets)
+                X = np.array(sequence.pad_sequences(t, maxlen=20, padding='post'))
+
+            # the scoring service dispatches on the mode saved here, never on which files happen to exist
+            with open(paths.model('features.json'), 'w') as handle:
+                json.dump(features, handle)
+
+            y = sentiment
+            print(X.shape, y.shape)
+            y[y == 4] = 1
+
+        with stage('build'):
+            model = Sequential()
+            model.add(Embedding(vocab_size, 32, input_length=20))
+            model.add(Conv1D(filters=128, kernel_size=5, padding='same', activation='relu'))
+            model.add(MaxPooling1D(pool_size=2))
+            model.add(Dropout(0.2))
+            model.add(Conv1D(filters=64, kernel_size=6, padding='same', activation='relu'))
+            model.add(MaxPooling1D(pool_size=2))
+            model.add(Dropout(0.2))
+            model.add(Conv1D(filters=32, kernel_size=7, padding='same', activation='relu'))
+            model.add(MaxPooling1D(pool_size=2))
+            model.add(Dropout(0.2))
+            model.add(Conv1D(filters=32, kernel_size=8, padding='same', activation='relu'))
+            model.add(MaxPooling1D(pool_size=2))
+            model.add(Dropout(0.2))
+            model.add(Flatten())
+            model.add(Dense(1, activation='sigmoid'))
+
+            model.compile(
+                loss='binary_crossentropy',
+                optimizer='adam',
+                metrics=['accuracy']
+            )
+            model.summary()
+
+        with stage('fit'):
+            # MaxRuntimeInSeconds is passed in by the pipeline, save_margin_seconds is kept free for saving
+            max_runtime = get_hyper_param(hyper_params, 'max_runtime_seconds', 0)
+            save_margin = get_hyper_param(hyper_params, 'save_margin_seconds', 300)
+            deadline = None
+            if max_runtime > 0:
+                deadline = start + max_runtime - save_margin
+                if deadline <= time.time():
+                    raise RuntimeError('max_runtime_seconds of ' + str(max_runtime) + ' leaves no time for training')
+            budget = TrainingBudget(deadline)
+
+            validation_split = float(0.2)
+            history = model.fit(
+                X, y,
+                batch_size=int(10),
+                verbose=1,
+                validation_split=validation_split,
+                epochs=get_hyper_param(hyper_params, 'epochs', 1),
+                callbacks=[
+                    EarlyStopping(monitor='val_loss',
+                                  patience=get_hyper_param(hyper_params, 'early_stopping_patience', 2)),
+                    budget
+                ] + training_callbacks()
+            )
+
+            if budget.best_weights is None:
+                if budget.out_of_time:
+                    raise RuntimeError('The time budget ran out before the first epoch finished, '
+                                       'increase MaxRuntimeInSeconds or reduce the training data')
+                raise RuntimeError('No epoch finished with a usable val_loss')
+
+        with stage('save'):
+            model.save(paths.model(filename='model.h5'))
+
+        with stage('quantize'):
+            if deadline is not None and time.time() > deadline:
+                print("skipping quantization, the time budget is used up")
+                unpublish_quantized()
+            elif get_hyper_param(hyper_params, 'quantize', 'true').lower() == 'true':
+                # keras holds out the last validation_split of the samples, compare on exactly those
+                split_at = int(X.shape[0] * (1. - validation_split))
+                # half of the save margin stays free in case the export runs long
+                export_quantized(model, X[split_at:], y[split_at:],
+                                 max_accuracy_drop=get_hyper_param(hyper_params, 'quantize_max_accuracy_drop', 0.01),
+                                 max_prediction_diff=get_hyper_param(hyper_params, 'quantize_max_prediction_diff',
+                                                                     0.05),
+                                 deadline=None if deadline is None else deadline + save_margin / 2.)
+            else:
+                unpublish_quantized()
+    except Exception as e:
+        write_failure('Training failed after {:.0f}s: {}: {}'.format(time.time() - start, type(e).__name__, e))
+        raise
 '''
     print("loss:" + str(history.history['loss']))
     print("acc:" + str(history.history['acc']))
@@ -189,6 +189,7 @@ def main(event, context):
             )
 
             hyper_param_dict.update({'meta_data_store': str(os.environ["META_DATA_STORE"])})
+            hyper_param_dict.update({'max_runtime_seconds': str(os.environ["RUN_TIME_SEC"])})
 
             sage_res = sagemaker.create_training_job(
                 TrainingJobName=training_job_name,